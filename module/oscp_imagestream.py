@@ -56,6 +56,260 @@ options:
             - Name of imagestream
         required: true
         default: null
+
+    validate_certs:
+        description:
+            - Verify the TLS certificate of the Open Shift Master.
+        required: false
+        default: false
+
+    ca_bundle:
+        description:
+            - Path to a PEM file with the CA certificates used to verify the
+            - Open Shift Master. Implies validate_certs.
+        required: false
+        default: null
+
+    retries:
+        description:
+            - Number of times a request is retried on connection errors and
+            - on 429, 500, 502, 503 and 504 responses. POST requests are only
+            - retried when they did not reach the master, or on 429.
+        required: false
+        default: 3
+
+    retry_delay:
+        description:
+            - Base delay in seconds for the exponential backoff between retries.
+            - The actual delay is randomized (full jitter). A Retry-After
+            - header from the master is honoured.
+        required: false
+        default: 1.0
+
+    retry_max_delay:
+        description:
+            - Upper bound in seconds for the backoff between two retries.
+        required: false
+        default: 30.0
+
+    retry_deadline:
+        description:
+            - Total time in seconds a single request may spend retrying.
+            - No retry is started that would end after the deadline.
+        required: false
+        default: null
+
+    request_timeout:
+        description:
+            - Timeout in seconds for each request to the Open Shift Master.
+        required: false
+        default: 60
+
+    task_deadline:
+        description:
+            - Total time in seconds the task may spend talking to the
+            - Open Shift Master, shared by all requests and retries it makes.
+            - The task fails when the budget is used up.
+        required: false
+        default: null
+
+    list_cache:
+        description:
+            - Look up objects in a namespace through one LIST of the whole
+            - collection, stored in cache_dir and shared by all forks,
+            - instead of one GET per object.
+        required: false
+        default: false
+
+    cache_ttl:
+        description:
+            - Seconds a stored list is used before the collection is listed again.
+        required: false
+        default: 60
+
+    cache_dir:
+        description:
+            - Directory for cached data shared between tasks.
+            - Defaults to ~/.ansible/oscp_cache.
+        required: false
+        default: null
+
+    informer:
+        description:
+            - Look up objects through a local informer daemon that LISTs and
+            - WATCHes the collections and answers from memory. The daemon is
+            - started on demand and falls back to the master when it can not
+            - answer.
+        required: false
+        default: false
+
+    informer_idle_timeout:
+        description:
+            - Seconds without requests after which the informer daemon exits.
+        required: false
+        default: 900
+
+    broker:
+        description:
+            - Send all requests through a local broker daemon that keeps a
+            - few keep-alive connections to the master and shares them between
+            - all forks. The broker is started on demand and exits when idle.
+        required: false
+        default: false
+
+    broker_connections:
+        description:
+            - Maximum number of connections the broker keeps to the master.
+        required: false
+        default: 4
+
+    broker_idle_timeout:
+        description:
+            - Seconds without requests after which the broker exits.
+        required: false
+        default: 60
+
+    coalesce_gets:
+        description:
+            - Send identical GETs that are in flight at the same time, from
+            - any fork, only once and share the response. Uses the broker when
+            - enabled, otherwise lock files in cache_dir.
+        required: false
+        default: false
+
+    conditional_reads:
+        description:
+            - Keep read objects in cache_dir and on later runs only fetch their
+            - metadata. The full object is only fetched again when its
+            - resourceVersion has changed.
+        required: false
+        default: false
+
+    wire_format:
+        description:
+            - Encoding used to read ConfigMaps, ServiceAccounts and Services
+            - from the /api/v1 API. protobuf is cheaper for the master and
+            - smaller on the wire. Other kinds and all writes use JSON.
+            - Returned facts only hold the fields known to the module.
+        required: false
+        default: json
+        choices: [json, protobuf]
+
+    concurrency:
+        description:
+            - Maximum number of requests the module sends to the master at
+            - the same time, for example when checking several roles.
+        required: false
+        default: 8
+
+    qps:
+        description:
+            - Maximum average number of requests per second sent to the
+            - master, by all tasks on the controller together. The limit is
+            - kept in cache_dir. Not limited when not set.
+        required: false
+        default: null
+    burst:
+        description:
+            - Number of requests that may be sent at once before qps applies.
+        required: false
+        default: 10
+
+    adaptive_concurrency:
+        description:
+            - Learn how many concurrent requests the master handles well, up
+            - to concurrency. Fewer requests are sent at once when the master
+            - answers slowly or with errors. The learned limit is kept in
+            - cache_dir.
+        required: false
+        default: false
+
+    circuit_failures:
+        description:
+            - Number of failed connections in a row after which the master
+            - is taken to be down. Tasks using it then fail at once until
+            - circuit_cooldown has passed. Not used when not set.
+        required: false
+        default: null
+    circuit_cooldown:
+        description:
+            - Seconds to wait before trying a master that is taken to be down.
+        required: false
+        default: 30.0
+
+    update_method:
+        description:
+            - How an existing object that differs is updated. put replaces
+            - the whole object. merge sends a JSON merge patch and strategic
+            - a strategic merge patch, holding only the fields that differ.
+            - With strategic, lists like containers, ports and env are merged
+            - by name instead of replaced.
+        required: false
+        default: put
+        choices: [put, merge, strategic]
+
+    apply:
+        description:
+            - With server, the object is sent as a server-side apply, which
+            - creates or updates it in one request and lets the master work
+            - out what changed. Needs a master that supports server-side
+            - apply. changed is found from the managedFields entry of
+            - field_manager, compared to the one the last apply left in
+            - cache_dir, or to the object read before the first apply.
+            - Not used by oscp_project.
+        required: false
+        default: client
+        choices: [client, server]
+    field_manager:
+        description:
+            - Field manager name used with apply server.
+        required: false
+        default: oscp-ansible
+    force_conflicts:
+        description:
+            - With apply server, take over fields owned by other field
+            - managers instead of failing with a conflict.
+        required: false
+        default: false
+
+    conflict_retries:
+        description:
+            - Number of times an update that conflicts with a change made by
+            - someone else is retried, after a random wait that grows with
+            - each attempt and reading the object again.
+        required: false
+        default: 10
+
+    dry_run:
+        description:
+            - In check mode, send the writes to the master as a server-side
+            - dry run (dryRun=All), so that it validates them without storing
+            - anything. Needs a master that supports dry run.
+        required: false
+        default: false
+
+    fingerprint:
+        description:
+            - Write a hash of the desired object to the
+            - oscp.ansible/desired-state annotation, and skip the comparison
+            - on later runs while the object still holds that hash and its
+            - generation is unchanged. Such runs only read the metadata of
+            - the object, which is then all that is returned as facts.
+        required: false
+        default: false
+
+    ignore_fields:
+        description:
+            - Paths of fields that are neither compared nor updated, in the
+            - form used for the reported changes, e.g.
+            - spec.template.spec.containers[name=web].image. [*] matches any
+            - member of a list. On an update these fields keep the value they
+            - have on the master. The images of containers named by an
+            - ImageChange trigger of a DeploymentConfig are always ignored.
+            - Not used with apply server.
+        required: false
+        default: []
+
 '''
 
 
@@ -73,9 +327,25 @@ RETURN = '''
 
 
 import urllib2
+import urllib
+import httplib
+import socket
+import urlparse
 import ssl
 import json
-from string import Template
+import time
+import random
+import email.utils
+import os
+import re
+import fcntl
+import hashlib
+import copy
+import threading
+import base64
+import zlib
+from fractions import Fraction
+from StringIO import StringIO
 import types
 
 ## Constants:
@@ -84,48 +354,57 @@ API_BASE = "/oapi/v1"
 
 def main():
     module = AnsibleModule(
-        argument_spec = dict(
+        argument_spec = oscp_argument_spec(
             state                   = dict(default='present', choices=['present', 'absent']),
             master_url              = dict(required=True),
             auth_token              = dict(required=True),
             project                 = dict(required=True),
             name                    = dict(required=True)
-        )
+        ),
+        supports_check_mode = True
     )
 
     SERVICE  = API_BASE+"/namespaces/"+module.params.get("project")+"/imagestreams/"
     PATH = SERVICE+module.params.get("name")
 
-    TEMPLATE = '''
-    {
+    should_be = build_object({
         "kind": "ImageStream",
         "apiVersion": "v1",
         "metadata": {
-        "name": "$name",
-        "namespace": "$project"
+            "name": module.params.get("name"),
+            "namespace": module.params.get("project")
         }
-    }
-    '''
-
-    cfg = template_to_dict(TEMPLATE, module.params)
-    should_be = clean_dict_from_nones(cfg)
-    should_be_json = dict_to_json(should_be)
+    })
+    should_be = add_fingerprint(should_be, module)
 
     try:
-        current_json = http_get(PATH, module)
-        current = json_to_dict(current_json)
+        if module.params.get("apply") == "server" and module.params.get("state") == "present" and not module.check_mode:
+            changed, facts = apply_object(PATH, module, should_be)
+            module.exit_json(changed=changed, ansible_facts=facts)
+
+        metadata = fingerprint_get(PATH, module, should_be)
+        if metadata is not None:
+            module.exit_json(changed=False, ansible_facts=metadata)
+
+        current = get_object(PATH, module)
         # Only If resource exists on server ...
         if module.params.get("state") == "absent":
             http_delete(PATH,module)
-            module.exit_json(changed=True)
+            module.exit_json(changed=True, **diff_result(module, current, None))
             return
 
-        if compliant (current,should_be):
+        changes = diff_objects(current, should_be, ignore=ignored_fields(module, should_be))
+        if not changes:
+            fingerprint_written(PATH, module, current)
             module.exit_json(changed=False, ansible_facts=current)
         else:
-            result = http_put(PATH, module, dict_to_json(should_be))
+            updated, result = update_object(PATH, module, current, should_be)
             facts = json_to_dict(result)
-            module.exit_json(changed=True, ansible_facts=facts)
+            if not updated:
+                # Someone else made the same change first.
+                fingerprint_written(PATH, module, facts)
+                module.exit_json(changed=False, ansible_facts=facts)
+            module.exit_json(changed=True, ansible_facts=facts, **diff_result(module, current, should_be, changes))
 
     except urllib2.HTTPError as sc:
 
@@ -133,9 +412,9 @@ def main():
             module.fail_json(msg="Project does not exist")
 
         if sc.code == 404 and module.params.get("state") == "present":
-            result = http_post(SERVICE, module, should_be_json)
+            result = http_post(SERVICE, module, dict_to_json(should_be))
             facts = json_to_dict(result)
-            module.exit_json(changed=True, ansible_facts=facts)
+            module.exit_json(changed=True, ansible_facts=facts, **diff_result(module, None, should_be))
 
         if sc.code == 404 and module.params.get("state") == "absent":
             module.exit_json(changed=False)
@@ -143,15 +422,54 @@ def main():
 
 ########################### Helper functions ###################################
 #
-# This section contains helper fuctions v20170418:0
+# This section contains helper fuctions v20170418:23
 #
 ################################################################################
 
+# Argument spec for the module, extended with the connection options that are
+# shared by all oscp modules. Takes the same keyword arguments as dict().
+def oscp_argument_spec(**spec):
+    spec.update(dict(
+        validate_certs          = dict(required=False, default=False, type='bool'),
+        ca_bundle               = dict(required=False, default=None),
+        retries                 = dict(required=False, default=3, type='int'),
+        retry_delay             = dict(required=False, default=1.0, type='float'),
+        retry_max_delay         = dict(required=False, default=30.0, type='float'),
+        retry_deadline          = dict(required=False, default=None, type='float'),
+        request_timeout         = dict(required=False, default=60.0, type='float'),
+        task_deadline           = dict(required=False, default=None, type='float'),
+        list_cache              = dict(required=False, default=False, type='bool'),
+        cache_ttl               = dict(required=False, default=60.0, type='float'),
+        cache_dir               = dict(required=False, default=None),
+        informer                = dict(required=False, default=False, type='bool'),
+        informer_idle_timeout   = dict(required=False, default=900.0, type='float'),
+        broker                  = dict(required=False, default=False, type='bool'),
+        broker_connections      = dict(required=False, default=4, type='int'),
+        broker_idle_timeout     = dict(required=False, default=60.0, type='float'),
+        coalesce_gets           = dict(required=False, default=False, type='bool'),
+        conditional_reads       = dict(required=False, default=False, type='bool'),
+        wire_format             = dict(required=False, default='json', choices=['json', 'protobuf']),
+        concurrency             = dict(required=False, default=8, type='int'),
+        adaptive_concurrency    = dict(required=False, default=False, type='bool'),
+        qps                     = dict(required=False, default=None, type='float'),
+        burst                   = dict(required=False, default=10, type='int'),
+        circuit_failures        = dict(required=False, default=None, type='int'),
+        circuit_cooldown        = dict(required=False, default=30.0, type='float'),
+        update_method           = dict(required=False, default='put', choices=['put', 'merge', 'strategic']),
+        apply                   = dict(required=False, default='client', choices=['client', 'server']),
+        field_manager           = dict(required=False, default='oscp-ansible'),
+        force_conflicts         = dict(required=False, default=False, type='bool'),
+        conflict_retries        = dict(required=False, default=10, type='int'),
+        dry_run                 = dict(required=False, default=False, type='bool'),
+        fingerprint             = dict(required=False, default=False, type='bool'),
+        ignore_fields           = dict(required=False, default=[], type='list')
+    ))
+    return spec
+
 def has_role(role_name, user, module):
     path="/oapi/v1/namespaces/"+module.params.get("project")+"/rolebindings/"+role_name
     try:
-        res = http_get(path, module)
-        rolebindings = json_to_dict(res)
+        rolebindings = get_object(path, module)
         if isinstance (rolebindings["userNames"], list):
             for tst_usr in rolebindings.get("userNames"):
                 if tst_usr == user:
@@ -163,47 +481,68 @@ def has_role(role_name, user, module):
             module.fail_json(msg="Failed when finding roles for user server resp:"+sc.code)
     return False
 
+# Same as has_role for each role, checked concurrently.
+def has_roles(role_names, user, module):
+    return concurrently(lambda role_name, worker: has_role(role_name, user, worker), role_names, module)
+
+# Adds user to the rolebinding, or creates it. Other tasks may add users to
+# the same rolebinding at the same time, so on a conflict the rolebinding is
+# read again after a conflict_delay and the user added again, up to
+# conflict_retries times.
 def add_role(role_name, user, module):
-    if rolebinding_exist(role_name, module):
-        path="/oapi/v1/namespaces/"+module.params.get("project")+"/rolebindings/"+role_name
-        current_json=http_get(path, module)
-        current = json_to_dict (current_json)
-        if isinstance(current["userNames"], list):
+    path="/oapi/v1/namespaces/"+module.params.get("project")+"/rolebindings/"+role_name
+    if rolebinding_exist(role_name, module) or not create_rolebinding(role_name, user, module):
+        current = get_object(path, module)
+        retries = module.params.get("conflict_retries")
+        for attempt in range(retries + 1):
+            if not isinstance(current["userNames"], list):
+                current["userNames"] = []
+            if user in current["userNames"]:
+                return
             current["userNames"].append(user)
-        else:
-            current["userNames"] = [user]
-        http_put(path,module,dict_to_json(current))
-    else:
-        path="/oapi/v1/namespaces/"+module.params.get("project")+"/rolebindings"
-        params = dict(role_name=role_name, user=user, project=module.params['project'] )
-        rolebinding_template='''
-        {
-            "kind": "RoleBinding",
-            "apiVersion": "v1",
-            "metadata": {
-                "name": "$role_name",
-                "namespace": "$project"
-          },
-          "userNames": [
-            "$user"
-          ],
-          "groupNames": null,
-          "subjects": [],
-          "roleRef": {
-            "name": "$role_name"
-          }
+            try:
+                http_request("PUT", path, module, dict_to_json(current), conflicts=attempt < retries)
+                return
+            except urllib2.HTTPError as sc:
+                if sc.code != 409:
+                    raise
+            time.sleep(conflict_delay(module, attempt))
+            current = json_to_dict(http_request("GET", path, module, ""))
+    return
+
+# Returns False if the rolebinding was created by someone else first.
+def create_rolebinding(role_name, user, module):
+    path="/oapi/v1/namespaces/"+module.params.get("project")+"/rolebindings"
+    rolebinding = {
+        "kind": "RoleBinding",
+        "apiVersion": "v1",
+        "metadata": {
+            "name": role_name,
+            "namespace": module.params.get("project")
+        },
+        "userNames": [
+            user
+        ],
+        "groupNames": None,
+        "subjects": [],
+        "roleRef": {
+            "name": role_name
         }
-        '''
-        rolebinding = template_to_dict(rolebinding_template, params)
+    }
 
-        http_post(path, module, dict_to_json(rolebinding))
-    return
+    try:
+        http_request("POST", path, module, dict_to_json(rolebinding), conflicts=True)
+    except urllib2.HTTPError as sc:
+        if sc.code != 409:
+            raise
+        return False
+    return True
 
 
 def rolebinding_exist(role_name, module):
     url="/oapi/v1/namespaces/"+module.params.get("project")+"/rolebindings/"+role_name
     try:
-        res = http_get(url, module)
+        http_get_metadata(url, module)
         return True
     except urllib2.HTTPError as sc:
         if sc.code == 404:
@@ -217,42 +556,30 @@ def dict_to_json(in_dict):
     return json.dumps(in_dict)
 
 def json_to_dict(in_json):
+    # Objects served from the cache are already decoded.
+    if isinstance(in_json, dict):
+        return in_json
     return json.loads(in_json)
 
-# Cleans up dict. Removes entries that have a value of None.
-# Mainly used for cleaning up Templates with have vaules that are not set in the
-# module.
+# Builds an object from a field map, a dict of fields whose values are
+# options of the module or field maps again. Options that are not set, and
+# empty dicts and lists, are left out, also within the values of options.
+# Lists are taken as they are.
 # Consumes Dict, Returns Dict.
-def clean_dict_from_nones(in_dict):
-    return __clean_dict_from_nones_recursive(in_dict)
-
-
-def __clean_dict_from_nones_recursive(in_dict):
-    new_dict = dict ()
-    for key in in_dict:
-        if isinstance(in_dict[key], dict):
-            ret=__clean_dict_from_nones_recursive(in_dict[key])
-            if len(ret) > 0:
-                new_dict[key] = ret
-        elif isinstance(in_dict[key], list):
-            if len(in_dict[key]) > 0:
-                new_dict[key]=in_dict[key]
-        elif in_dict[key] != 'None':
-            new_dict[key]=in_dict[key]
-    return new_dict
-
-def template_to_dict(template, params):
-    # First: Create vaild json-strings from dicts that are nested.
-    fixed_params= dict();
-    for key in params:
-        if isinstance(params[key], dict) or isinstance(params[key], list) :
-            fixed_params[key] = json.dumps(params[key])
-        else:
-            fixed_params[key] = params[key]
-
-    jsonified = Template(template).substitute(fixed_params)
-    #print jsonified
-    return json.loads(jsonified)
+def build_object(fields):
+    obj = dict()
+    for key in fields:
+        value = fields[key]
+        if isinstance(value, dict):
+            value = build_object(value)
+            if len(value) > 0:
+                obj[key] = value
+        elif isinstance(value, list):
+            if len(value) > 0:
+                obj[key] = value
+        elif value is not None:
+            obj[key] = value
+    return obj
 
 
 # Takes two Python Dicts and compare them
@@ -260,31 +587,285 @@ def template_to_dict(template, params):
 # the function returns False
 # is_obj MAY contain more attributes then should_be. Thoose are never checked.
 # Returns True or False.
-def compliant (is_obj, should_be):
-    if not isinstance(is_obj, dict):
-        return False
+def compliant (is_obj, should_be, ignore=()):
+    return isinstance(is_obj, dict) and not diff_objects(is_obj, should_be, ignore=ignore)
+
+# Compares two Python Dicts like compliant, but returns all differences.
+# Each difference is a dict(path, old, new), where path is the dotted path
+# of the field, e.g. spec.replicas, old the value in is_obj (None when
+# missing) and new the value in should_be. Members of lists with a merge key
+# are found by key, e.g. spec.template.spec.containers[name=web].image.
+# Fields matching one of the ignore patterns (see ignored_fields) are skipped.
+# Returns List.
+def diff_objects(is_obj, should_be, path="", ignore=()):
+    changes = []
+    for key in should_be:
+        key_path = path+"."+key if path else key
+        current = is_obj.get(key) if isinstance(is_obj, dict) else None
+        changes.extend(diff_value(current, should_be[key], key, key_path, ignore))
+    return changes
+
+def diff_value(current, should_be, key, path, ignore=()):
+    if is_ignored(path, ignore):
+        return []
+    # Recursiv processing of dicts.
+    if isinstance(should_be, dict) and (current is None or isinstance(current, dict)):
+        return diff_objects(current or {}, should_be, path, ignore)
+    if isinstance(should_be, list) and isinstance(current, list) and key in LIST_MERGE_KEYS:
+        changes = diff_keyed_list(current, should_be, LIST_MERGE_KEYS[key], path, ignore)
+        if changes is not None:
+            return changes
+    if should_be != current:
+        return [dict(path=path, old=current, new=should_be)]
+    return []
+
+# Lists whose members are matched by a merge key instead of by position, as
+# the master does for a strategic merge. The key is a tuple of fields, each
+# with the default the master uses when it is not set. A field may be a
+# dotted path into the member, e.g. imageChangeParams.from.name.
+LIST_MERGE_KEYS = {
+    "containers":       (("name", None),),
+    "initContainers":   (("name", None),),
+    "env":              (("name", None),),
+    "volumes":          (("name", None),),
+    "volumeMounts":     (("mountPath", None),),
+    "ports":            (("containerPort", None), ("port", None), ("protocol", "TCP")),
+    "imagePullSecrets": (("name", None),),
+    "secrets":          (("name", None),),
+    "triggers":         (("type", None), ("imageChangeParams.from.name", None)),
+}
+
+# Compares the members of two lists by merge key, in any order and with the
+# same subset semantics as dicts: members only in current are never checked,
+# like the fields only in is_obj. Returns None if the lists can not be keyed,
+# e.g. when a key occurs twice, so that they are compared as a whole.
+def diff_keyed_list(current, should_be, keys, path, ignore=()):
+    index = keyed_index(current, keys)
+    if index is None:
+        return None
+
+    changes = []
+    seen = set()
+    for item in should_be:
+        if not isinstance(item, dict):
+            return None
+        item_key = merge_key(item, keys)
+        if item_key in seen:
+            return None
+        seen.add(item_key)
+        item_path = keyed_path(path, keys, item_key)
+        if is_ignored(item_path, ignore):
+            continue
+        if item_key in index:
+            changes.extend(diff_objects(index[item_key], item, item_path, ignore))
+        else:
+            changes.append(dict(path=item_path, old=None, new=item))
+    return changes
+
+# The members of a list by merge key. Returns Dict, or None if the list can
+# not be keyed.
+def keyed_index(items, keys):
+    index = dict()
+    for item in items:
+        if not isinstance(item, dict):
+            return None
+        index[merge_key(item, keys)] = item
+    if len(index) != len(items):
+        return None
+    return index
+
+def merge_key(item, keys):
+    values = []
+    for field, default in keys:
+        value = item
+        for name in field.split("."):
+            value = value.get(name) if isinstance(value, dict) else None
+        values.append(default if value is None else value)
+    return tuple(values)
+
+def keyed_path(path, keys, item_key):
+    return path+"["+",".join(field+"="+unicode(value) for (field, default), value in zip(keys, item_key)
+                             if value is not None)+"]"
+
+# Fields that are neither compared nor updated: the ignore_fields of the task
+# and the container images of a DeploymentConfig that its ImageChange
+# triggers set to the image the trigger resolved. Each is a path as in the
+# changes, where [*] matches any member of a list, and covers all fields
+# below it.
+# Returns List of compiled patterns.
+def ignored_fields(module, should_be):
+    paths = list(module.params.get("ignore_fields") or [])
+    for trigger in (should_be.get("spec") or {}).get("triggers") or []:
+        if not isinstance(trigger, dict) or trigger.get("type") != "ImageChange":
+            continue
+        for name in (trigger.get("imageChangeParams") or {}).get("containerNames") or []:
+            paths.append("spec.template.spec.containers[name="+name+"].image")
+            paths.append("spec.template.spec.initContainers[name="+name+"].image")
+    return [re.compile("^"+re.escape(path).replace(re.escape("[*]"), r"\[[^\]]*\]")+r"($|[.\[])")
+            for path in paths]
+
+def is_ignored(path, ignore):
+    for pattern in ignore:
+        if pattern.match(path):
+            return True
+    return False
+
+# Copy of should_be where the ignored fields hold their value in current, so
+# that an update keeps them. Where current does not have them, e.g. in a new
+# member of a list, they keep the value of should_be.
+# Returns Dict.
+def keep_ignored(current, should_be, ignore, path=""):
+    if not ignore:
+        return should_be
+    result = dict()
+    for key in should_be:
+        key_path = path+"."+key if path else key
+        value = should_be[key]
+        old = current.get(key) if isinstance(current, dict) else None
+        if is_ignored(key_path, ignore):
+            result[key] = value if old is None else old
+        elif isinstance(value, dict):
+            result[key] = keep_ignored(old, value, ignore, key_path)
+        elif isinstance(value, list) and key in LIST_MERGE_KEYS and keyed_index(value, LIST_MERGE_KEYS[key]) is not None:
+            keys = LIST_MERGE_KEYS[key]
+            index = keyed_index(old if isinstance(old, list) else [], keys) or dict()
+            result[key] = [keep_ignored(index.get(merge_key(item, keys)), item, ignore,
+                                        keyed_path(key_path, keys, merge_key(item, keys)))
+                           for item in value]
+        else:
+            result[key] = value
+    return result
+
+# Result fields for a change of an object: the list of changes and, when
+# Ansible runs with --diff, the object before and after the change.
+# before is None for a created object, should_be None for a deleted one,
+# which is a single change of the whole object.
+# Returns Dict.
+def diff_result(module, before, should_be, changes=None):
+    if changes is None and should_be is None:
+        changes = [dict(path="", old=before, new=None)]
+    elif changes is None:
+        changes = diff_objects(before or {}, should_be)
+    result = dict(changes=changes)
+    if getattr(module, "_diff", False):
+        if should_be is None:
+            after = dict()
+        else:
+            after = overlay(before or {}, should_be)
+        result["diff"] = dict(before=before or {}, after=after)
+    return result
 
-    is_compliant = True
+# Copy of base with the fields of should_be set on it.
+# Returns Dict.
+def overlay(base, should_be):
+    result = dict(base)
     for key in should_be:
-        # Recursiv processing of dicts.
-        if isinstance(should_be[key], dict):
-            is_compliant = compliant (is_obj[key], should_be[key])
-            if not is_compliant:
-                return False
+        if isinstance(should_be[key], dict) and isinstance(base.get(key), dict):
+            result[key] = overlay(base[key], should_be[key])
         else:
-            # Check values.
-                #print "Checking if should_be[key] != is_obj[key]: " + should_be[key] +":"+ is_obj[key]
-            if should_be[key] != is_obj[key]:
-                    is_compliant = False
-                    return False
-    return is_compliant
+            result[key] = should_be[key]
+    return result
+
+# Fields of should_be that differ from is_obj, as a JSON merge patch.
+# Like in compliant, fields that are only in is_obj are left as they are.
+# Returns Dict.
+def merge_patch(is_obj, should_be):
+    patch = dict()
+    for key in should_be:
+        current = is_obj.get(key) if isinstance(is_obj, dict) else None
+        if isinstance(should_be[key], dict) and isinstance(current, dict):
+            changes = merge_patch(current, should_be[key])
+            if changes:
+                patch[key] = changes
+        elif diff_value(current, should_be[key], key, key):
+            patch[key] = should_be[key]
+    return patch
+
+# Updates the object at path to should_be. With update_method put the whole
+# object is sent, with the resourceVersion and status of current, with merge
+# or strategic only the fields that differ from current. If someone else
+# changed the object in the meantime (409 Conflict), it is read again after
+# a conflict_delay and updated again if it still differs, up to
+# conflict_retries times.
+# Ignored fields (see ignored_fields) keep the value they have in current.
+# Returns (changed, object): the response body, or (False, object read again)
+# if it already complies.
+def update_object(path, module, current, should_be):
+    update_method = module.params.get("update_method")
+    retries = module.params.get("conflict_retries")
+    ignore = ignored_fields(module, should_be)
+    for attempt in range(retries + 1):
+        try:
+            if update_method == "put":
+                body = keep_ignored(current, should_be, ignore)
+                body = dict(body, metadata=dict(body["metadata"],
+                                                resourceVersion=current["metadata"]["resourceVersion"]))
+                if "status" in current:
+                    body["status"] = current["status"]
+                return True, http_request("PUT", path, module, dict_to_json(body), conflicts=attempt < retries)
+            patch = merge_patch(current, keep_ignored(current, should_be, ignore))
+            return True, http_request("PATCH", path, module, dict_to_json(patch), conflicts=attempt < retries,
+                                      headers={"Content-Type": PATCH_CONTENT_TYPES[update_method]})
+        except urllib2.HTTPError as sc:
+            if sc.code != 409:
+                raise
+        time.sleep(conflict_delay(module, attempt))
+        current = json_to_dict(http_request("GET", path, module, ""))
+        if compliant(current, should_be, ignore):
+            return False, current
+
+# Seconds to wait after a 409 Conflict before reading the object again. The
+# wait is random and grows with each attempt like retry_delay, so that tasks
+# that update the same object at the same time do not collide again.
+def conflict_delay(module, attempt):
+    return random.uniform(0, min(module.params.get("retry_max_delay"),
+                                 module.params.get("retry_delay") * (2 ** attempt) / 10.0))
+
+# Sends should_be as a server-side apply of field_manager, which creates or
+# updates the object in one request. The server does not tell whether the
+# apply changed anything, so the apply_signature of the result is compared
+# to the one left by the last apply of this object, kept in cache_dir.
+# Without it, the metadata of the object is read before the apply.
+# Returns (changed, object).
+def apply_object(path, module, should_be):
+    manager = module.params.get("field_manager")
+    filename = cache_file(module, "apply:"+path, ".apply")
+    applied = read_cache_file(filename)
+    if applied is not None:
+        before = applied.get("signature")
+    else:
+        try:
+            before = apply_signature(json_to_dict(http_get_metadata(path, module)), manager)
+        except urllib2.HTTPError as sc:
+            if sc.code != 404:
+                raise
+            before = None
+    query = urllib.urlencode(dict(fieldManager=manager,
+                                  force=str(module.params.get("force_conflicts")).lower()))
+    result = json_to_dict(http_patch(path+"?"+query, module, dict_to_json(should_be), APPLY_CONTENT_TYPE))
+    after = apply_signature(result, manager)
+    if after != before:
+        write_cache_file(filename, dict_to_json(dict(signature=after)))
+    return after != before, result
+
+# What an apply of manager moves when it changes the object: the uid and the
+# Apply entry of manager in managedFields, whose time and fields the master
+# only updates when the fields manager owns or their values change. Unlike
+# the resourceVersion, writes of others, e.g. to the status, leave it as it is.
+# Returns String.
+def apply_signature(obj, manager):
+    metadata = obj.get("metadata") or {}
+    entries = [entry for entry in metadata.get("managedFields") or []
+               if entry.get("manager") == manager and entry.get("operation") == "Apply"]
+    return hashlib.sha1(json.dumps([metadata.get("uid"), entries],
+                                   sort_keys=True, separators=(",", ":"))).hexdigest()
 
 # Checks if project exist.
 # Returns True/False
 def has_project(module):
     try:
         path = "/oapi/v1/projects/"+module.params["project"]
-        http_get(path, module)
+        http_get_metadata(path, module)
     except urllib2.HTTPError as sc:
         if sc.code == 404:
             return False
@@ -296,8 +877,12 @@ def get_message_from_v1status(body):
     if isinstance(body,list):
         body=''.join(body)
     #json to obj.
-    status = json.loads(body)
-    return status['message']
+    try:
+        status = json.loads(body)
+        return status['message']
+    except (ValueError, KeyError, TypeError):
+        # Not a v1.Status, e.g. an error page from a load balancer.
+        return body
 
 #####################################
 # HTTP Helper functions
@@ -309,46 +894,117 @@ def get_message_from_v1status(body):
 #
 #####################################
 def http_get(path, module):
+    cached = cached_get(path, module)
+    if cached is not None:
+        return cached
     return http_request("GET", path, module, "")
 
+# GET that only needs the metadata of the object, e.g. to check that it
+# exists. Masters that do not know PartialObjectMetadata send the full object.
+def http_get_metadata(path, module):
+    cached = cached_get(path, module)
+    if cached is not None:
+        return cached
+    return http_request("GET", path, module, "", headers={"Accept": METADATA_ACCEPT})
+
 def http_post(path, module, data):
     return http_request("POST", path, module, data)
 
 def http_put(path, module, data):
     return http_request("PUT", path, module, data)
 
+PATCH_CONTENT_TYPES = dict(merge="application/merge-patch+json",
+                           strategic="application/strategic-merge-patch+json")
+
+# JSON is valid YAML, so the JSON body can be sent as an apply patch.
+APPLY_CONTENT_TYPE = "application/apply-patch+yaml"
+
+def http_patch(path, module, data, content_type):
+    return http_request("PATCH", path, module, data, headers={"Content-Type": content_type})
+
 def http_delete(path, module):
     return http_request("DELETE", path, module, "")
 
-def http_request(method, path, module, data):
+# Returns the body of the response. With full_response, returns
+# (status, headers, body) instead, which is needed for 304 Not Modified.
+# With conflicts, a 409 Conflict is raised as HTTPError for the caller to
+# resolve, instead of failing the task.
+# In check mode writes are not sent and the body that would have been sent is
+# returned. With dry_run they are sent with dryRun=All instead, so that the
+# master validates them without storing anything.
+# With decode, a successful body is returned as decode(chunks) instead, where
+# chunks are read from the connection as they arrive.
+def http_request(method, path, module, data, headers=None, full_response=False, decode=None, conflicts=False):
+    check_mode = method != "GET" and getattr(module, "check_mode", False)
+    if check_mode:
+        if not module.params.get("dry_run"):
+            return data
+        path += ("&" if "?" in path else "?")+"dryRun=All"
+
     try:
         url = module.params.get("master_url")+path
-        #opener = urllib2.build_opener(urllib2.HTTPHandler)
-        headers = {'Authorization': 'Bearer '+module.params.get("auth_token")}
-
-        #GET
-        req = urllib2.Request(url=url, headers=headers)
+        requested = headers
+        headers = dict(headers or {})
+        headers['Authorization'] = 'Bearer '+module.params.get("auth_token")
+        if method == "GET" and "Accept" not in headers and use_protobuf(path, module):
+            headers["Accept"] = PROTOBUF_ACCEPT
 
-        if method == "DELETE":
-            req = urllib2.Request(url=url, headers=headers)
-            req.get_method = lambda: 'DELETE'
+        if method == "POST" or method == "PUT" or method == "PATCH":
+            headers.setdefault("Content-Type", "application/json")
+        else:
+            data = None
 
-        elif method == "POST":
-            req = urllib2.Request(url=url, headers=headers, data=data)
-            req.add_header("Content-Type", "application/json")
+        deadline = task_deadline(module)
+        if module.params.get("retry_deadline"):
+            retry_end = time.time() + module.params.get("retry_deadline")
+            if deadline is None or retry_end < deadline:
+                deadline = retry_end
 
-        elif method == "PUT":
-            req = urllib2.Request(url=url, headers=headers, data=data)
-            req.add_header("Content-Type", "application/json")
-            req.get_method = lambda: 'PUT'
+        attempt = 0
+        while True:
+            attempt += 1
+            circuit_check(module)
+            try:
+                status, reason, resp_headers, content = limited_send(method, path, module, data, headers, decode)
+            except urllib2.URLError as ue:
+                # A certificate that failed verification does not get better.
+                if getattr(ue, "tls_failed", False):
+                    raise
+                delay = retry_delay(module, method, attempt, deadline, sent=ue.sent)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
 
-        ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
+            if is_protobuf(resp_headers):
+                try:
+                    content = decode_protobuf(content)
+                except ValueError:
+                    # No schema for this kind, ask for JSON instead.
+                    if status < 400:
+                        return http_request(method, path, module, data, dict(requested or {}, Accept="application/json"),
+                                            full_response, decode, conflicts)
+                    content = ""
+                if status >= 400:
+                    content = dict_to_json(content)
 
-        content = urllib2.urlopen(req, context=ctx).read()
+            if status >= 400:
+                delay = retry_delay(module, method, attempt, deadline, status=status,
+                                    retry_after=resp_headers.getheader("Retry-After"))
+                if delay is not None:
+                    time.sleep(delay)
+                    continue
+                raise urllib2.HTTPError(url, status, reason, resp_headers, StringIO(content))
 
-        return content
+            if method != "GET" and not check_mode:
+                written = path.split("?")[0]
+                list_cache_invalidate(written, module)
+                informer_written(written, module, content)
+                object_cache_written(method, written, module, content)
+                fingerprint_written(written, module, content, method)
+            if full_response:
+                return status, resp_headers, content
+            return content
 
     except urllib2.HTTPError as sc:
         if sc.code == 401:
@@ -356,7 +1012,7 @@ def http_request(method, path, module, data):
             msg = msg + get_message_from_v1status(sc.readlines())
             module.fail_json(msg=msg)
 
-        elif sc.code == 409:
+        elif sc.code == 409 and not conflicts:
             msg = "Open Shift Reports Conflict (409). Can't update resource:"
             msg = msg + get_message_from_v1status(sc.readlines())
             module.fail_json(msg=msg)
@@ -368,11 +1024,1618 @@ def http_request(method, path, module, data):
             msg = "Open Shift Reports Bad Request (400):"
             msg = msg + get_message_from_v1status(sc.readlines())
             module.fail_json(msg=msg)
+        elif sc.code in RETRY_STATUSES:
+            msg = "Open Shift Master reports a transient error ("+str(sc.code)+"). Giving up:"
+            msg = msg + get_message_from_v1status(sc.readlines())
+            module.fail_json(msg=msg)
         else:
             raise sc
 
     except urllib2.URLError as ue:
+        if isinstance(ue.reason, socket.timeout):
+            module.fail_json(msg="Open Shift Master did not respond within "+str(module.params.get("request_timeout"))+" seconds.")
+        if isinstance(ue.reason, (ssl.SSLError, ssl.CertificateError)):
+            module.fail_json(msg="TLS verification of Open Shift Master failed. Check validate_certs and ca_bundle settings: "+str(ue.reason))
         module.fail_json(msg="Open Shift Master is unreachable. Check connection and master_url setting.")
+
+# Object from the informer or the list cache, if enabled and able to answer.
+def cached_get(path, module):
+    if module.params.get("informer"):
+        cached = informer_get(path, module)
+        if cached is not None:
+            return cached
+    if module.params.get("list_cache"):
+        cached = list_cache_get(path, module)
+        if cached is not None:
+            return cached
+    return None
+
+#####################################
+# List cache
+# With list_cache enabled, the first GET of a named object in a namespace
+# LISTs the whole collection (paginated) and stores it in cache_dir. Later
+# lookups of any object in that collection, also from other forks, are served
+# from the stored list until cache_ttl has passed. Writes through the http_*
+# helpers drop the stored list of the collection they touch.
+#
+#####################################
+LIST_PAGE_SIZE = 500
+NAMESPACED_PATH = re.compile(r'^(/o?api/v1/namespaces/[^/]+/[^/]+)/([^/?]+)$')
+_LIST_CACHE = dict()
+
+def get_cache_dir(module):
+    cache_dir = module.params.get("cache_dir")
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".ansible", "oscp_cache")
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir, 0o700)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    return cache_dir
+
+# Cache files are per master, token and key, as what a token may see differs.
+def cache_file(module, key, suffix):
+    digest = hashlib.sha1(module.params.get("master_url")+"\0"+module.params.get("auth_token")+"\0"+key).hexdigest()
+    return os.path.join(get_cache_dir(module), digest+suffix)
+
+def write_cache_file(filename, content):
+    tmp = filename+".tmp."+str(os.getpid())+"."+str(threading.current_thread().ident)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.rename(tmp, filename)
+
+def read_cache_file(filename):
+    try:
+        with open(filename) as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+# Returns the cached object for path, or None if path is not cacheable.
+# Raises HTTPError 404 if the object is not in the collection.
+def list_cache_get(path, module):
+    match = NAMESPACED_PATH.match(path)
+    if match is None:
+        return None
+    collection, name = match.groups()
+
+    entry = _LIST_CACHE.get(collection)
+    if entry is None or time.time() - entry["fetched"] > module.params.get("cache_ttl"):
+        entry = load_list(collection, module)
+        _LIST_CACHE[collection] = entry
+
+    item = entry["items"].get(name)
+    if item is None:
+        raise not_found_error(path, module)
+    return copy.deepcopy(item)
+
+# The HTTPError a GET of path would have raised for a missing object.
+def not_found_error(path, module):
+    url = module.params.get("master_url")+path
+    body = dict(kind="Status", apiVersion="v1", status="Failure", reason="NotFound", code=404,
+                message=path+" not found")
+    return urllib2.HTTPError(url, 404, "Not Found", None, StringIO(dict_to_json(body)))
+
+# Collection a path belongs to, for both object paths and POSTs to a collection.
+def collection_of(path):
+    match = NAMESPACED_PATH.match(path)
+    if match is not None:
+        return match.group(1)
+    return path.rstrip("/")
+
+# Returns a fresh list of the collection, from disk if another process has
+# just listed it, otherwise from the master. The lock makes concurrent forks
+# wait for a single LIST instead of all listing at once.
+def load_list(collection, module):
+    filename = cache_file(module, collection, ".list")
+    with open(filename+".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            entry = read_cache_file(filename)
+            if entry is not None and time.time() - entry["fetched"] <= module.params.get("cache_ttl"):
+                return entry
+            entry = list_collection(collection, module)
+            write_cache_file(filename, dict_to_json(entry))
+            return entry
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+# LISTs a collection page by page.
+# Returns dict(fetched, resourceVersion, items) with items keyed by name.
+def list_collection(collection, module):
+    fetched = time.time()
+    items = dict()
+    token = None
+    while True:
+        query = "?limit="+str(LIST_PAGE_SIZE)
+        if token:
+            query = query+"&continue="+urllib.quote(token, safe="")
+        try:
+            page = http_request("GET", collection+query, module, "", decode=decode_list)
+        except urllib2.HTTPError as sc:
+            # The continue token expired (410 Gone), start over in one go.
+            if sc.code != 410 or token is None:
+                raise
+            page = http_request("GET", collection, module, "", decode=decode_list)
+            items = dict()
+            token = None
+
+        kind = page.get("kind", "")
+        if kind.endswith("List"):
+            kind = kind[:-len("List")]
+        for item in page.get("items") or []:
+            item.setdefault("kind", kind)
+            item.setdefault("apiVersion", page.get("apiVersion"))
+            items[item["metadata"]["name"]] = item
+
+        metadata = page.get("metadata") or {}
+        token = metadata.get("continue")
+        if not token:
+            return dict(fetched=fetched, resourceVersion=metadata.get("resourceVersion"), items=items)
+
+def list_cache_invalidate(path, module):
+    if not module.params.get("list_cache"):
+        return
+    collection = collection_of(path)
+    _LIST_CACHE.pop(collection, None)
+    try:
+        os.remove(cache_file(module, collection, ".list"))
+    except OSError:
+        pass
+
+#####################################
+# Conditional reads
+# With conditional_reads enabled, get_object keeps the objects it reads in
+# cache_dir. On the next read only the metadata of the object is fetched
+# (PartialObjectMetadata, a few hundred bytes). If its resourceVersion is
+# unchanged the cached object is used, otherwise the full object is fetched,
+# conditionally on its ETag when the master sends one.
+#
+#####################################
+METADATA_ACCEPT = "application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1,application/json"
+
+# Reads an object and returns it as a dict.
+def get_object(path, module):
+    if not module.params.get("conditional_reads"):
+        return json_to_dict(http_get(path, module))
+
+    cached = cached_get(path, module)
+    if cached is not None:
+        return json_to_dict(cached)
+
+    filename = cache_file(module, "object:"+path, ".object")
+    entry = read_cache_file(filename)
+    headers = dict()
+    if entry is not None:
+        metadata = json_to_dict(http_get_metadata(path, module)).get("metadata", {})
+        if metadata.get("resourceVersion") == entry["object"]["metadata"].get("resourceVersion"):
+            return entry["object"]
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+
+    status, resp_headers, content = http_request("GET", path, module, "", headers=headers, full_response=True)
+    if status == 304:
+        return entry["object"]
+    current = json_to_dict(content)
+    write_cache_file(filename, dict_to_json(dict(etag=resp_headers.getheader("ETag"), object=current)))
+    return current
+
+# Keeps the object cache in step with writes, so that the next task finds the
+# written object with its current resourceVersion.
+def object_cache_written(method, path, module, content):
+    if not module.params.get("conditional_reads"):
+        return
+    try:
+        written = json_to_dict(content)
+        name = written["metadata"]["name"]
+    except (ValueError, KeyError, TypeError):
+        written = None
+    if method == "DELETE" or written is None or written.get("kind") == "Status":
+        try:
+            os.remove(cache_file(module, "object:"+path, ".object"))
+        except OSError:
+            pass
+        return
+    path = collection_of(path)+"/"+name
+    write_cache_file(cache_file(module, "object:"+path, ".object"), dict_to_json(dict(etag=None, object=written)))
+
+#####################################
+# Fingerprints
+# With fingerprint enabled, the desired object is written with an annotation
+# holding a hash of it. After a write, or a run that found the object
+# compliant, the hash and the generation of the object are kept in
+# cache_dir. A later run with the same desired object then only reads the
+# metadata of the object: when the annotation still holds the hash and the
+# generation is unchanged, nobody changed the spec since and the object
+# complies without comparing it. Kinds without a generation use the
+# resourceVersion instead.
+#
+#####################################
+FINGERPRINT_ANNOTATION = "oscp.ansible/desired-state"
+
+# Sets the fingerprint annotation on should_be. Returns should_be.
+def add_fingerprint(should_be, module):
+    if not module.params.get("fingerprint"):
+        return should_be
+    digest = hashlib.sha1(json.dumps(should_be, sort_keys=True, separators=(",", ":"))).hexdigest()
+    should_be.setdefault("metadata", {}).setdefault("annotations", {})[FINGERPRINT_ANNOTATION] = digest
+    return should_be
+
+def fingerprint_version(metadata):
+    if metadata.get("generation"):
+        return "generation:"+str(metadata["generation"])
+    return "resourceVersion:"+str(metadata.get("resourceVersion"))
+
+# Returns the metadata of the object at path if it was written from
+# should_be and not changed since, otherwise None.
+# Raises HTTPError 404 if the object does not exist.
+def fingerprint_get(path, module, should_be):
+    if not module.params.get("fingerprint") or module.params.get("state") != "present":
+        return None
+    digest = should_be["metadata"]["annotations"][FINGERPRINT_ANNOTATION]
+    recorded = read_cache_file(cache_file(module, "fingerprint:"+path, ".fingerprint"))
+    if recorded is None or recorded.get("hash") != digest:
+        return None
+    metadata = json_to_dict(http_get_metadata(path, module)).get("metadata", {})
+    if (metadata.get("annotations") or {}).get(FINGERPRINT_ANNOTATION) != digest:
+        return None
+    if recorded.get("version") != fingerprint_version(metadata):
+        return None
+    return dict(metadata=metadata)
+
+# Keeps the fingerprint and generation of a written or compliant object.
+def fingerprint_written(path, module, content, method="GET"):
+    if not module.params.get("fingerprint") or getattr(module, "check_mode", False):
+        return
+    try:
+        metadata = json_to_dict(content)["metadata"]
+        path = collection_of(path)+"/"+metadata["name"]
+        digest = (metadata.get("annotations") or {})[FINGERPRINT_ANNOTATION]
+    except (ValueError, KeyError, TypeError):
+        digest = None
+    filename = cache_file(module, "fingerprint:"+path, ".fingerprint")
+    if method == "DELETE" or digest is None:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        return
+    write_cache_file(filename, dict_to_json(dict(hash=digest, version=fingerprint_version(metadata))))
+
+#####################################
+# Informer
+# With informer enabled, GETs of named objects are first sent to a local
+# informer daemon. It LISTs and then WATCHes every collection it is asked
+# about and answers from memory over a Unix socket in cache_dir. The daemon
+# is started by the first module that needs it and exits after
+# informer_idle_timeout seconds without requests. Whenever it can not answer,
+# the modules fall back to asking the master.
+#
+#####################################
+INFORMER_PATH = re.compile(r'^(/o?api/v1/namespaces/[^/]+/[^/]+|/oapi/v1/projects)/([^/?]+)$')
+WATCH_TIMEOUT = 300
+INFORMER_SYNC_WAIT = 10.0
+
+def informer_socket(module):
+    return daemon_socket(module, "informer")
+
+# Returns the object from the informer, None if the informer can not answer.
+# Raises HTTPError 404 if the informer knows the object does not exist.
+def informer_get(path, module):
+    if INFORMER_PATH.match(path) is None:
+        return None
+    reply = unix_call(informer_socket(module), dict(path=path), module, informer_serve)
+    if reply is None or reply.get("status") not in (200, 404):
+        return None
+    if reply["status"] == 404:
+        raise not_found_error(path, module)
+    return reply["object"]
+
+# Tells a running informer about a write, so it does not answer from a store
+# that has not yet seen the write through its watch.
+def informer_written(path, module, content):
+    if not module.params.get("informer"):
+        return
+    resource_version = None
+    try:
+        resource_version = json_to_dict(content)["metadata"]["resourceVersion"]
+    except (ValueError, KeyError, TypeError):
+        pass
+    unix_call(informer_socket(module), dict(written=collection_of(path), resourceVersion=resource_version), module)
+
+# Entry point of the informer daemon.
+def informer_serve(sock_path, params):
+    module = DaemonModule(params)
+    reflectors = dict()
+    lock = threading.Lock()
+
+    def handle(request):
+        if "written" in request:
+            with lock:
+                reflector = reflectors.get(request["written"])
+            if reflector is not None:
+                reflector_written(reflector, request.get("resourceVersion"))
+            return dict(status="ok")
+
+        match = INFORMER_PATH.match(request.get("path", ""))
+        if match is None:
+            return dict(status="unavailable")
+        collection, name = match.groups()
+        with lock:
+            reflector = reflectors.get(collection)
+            if reflector is None:
+                reflector = start_reflector(collection, module)
+                reflectors[collection] = reflector
+        # Only the first LIST is waited for. After it, also if it failed, e.g.
+        # without the right to list, or while relisting, it answers right away.
+        reflector["listed"].wait(INFORMER_SYNC_WAIT)
+        return reflector_get(reflector, name)
+
+    serve_unix(sock_path, handle, params.get("informer_idle_timeout"))
+
+# A reflector keeps the items of one collection in sync with the master.
+def start_reflector(collection, module):
+    reflector = dict(collection=collection, items=dict(), resourceVersion=None,
+                     written=0, dirty_until=0, synced=threading.Event(), listed=threading.Event(),
+                     lock=threading.Lock())
+    thread = threading.Thread(target=run_reflector, args=(reflector, module))
+    thread.daemon = True
+    thread.start()
+    return reflector
+
+def run_reflector(reflector, module):
+    while True:
+        try:
+            entry = list_collection(reflector["collection"], module)
+            with reflector["lock"]:
+                reflector["items"] = entry["items"]
+                reflector["resourceVersion"] = entry["resourceVersion"]
+                reflector["synced"].set()
+            reflector["listed"].set()
+            while True:
+                watch_collection(reflector, module)
+        except Exception:
+            # Relist after a failure or an expired watch (410 Gone).
+            reflector["synced"].clear()
+            reflector["listed"].set()
+            time.sleep(5)
+
+# Applies watch events to the reflector until the master ends the watch.
+def watch_collection(reflector, module):
+    url = urlparse.urlparse(module.params.get("master_url"))
+    path = url.path.rstrip("/")+reflector["collection"]+"?watch=true&timeoutSeconds="+str(WATCH_TIMEOUT)
+    path = path+"&resourceVersion="+urllib.quote(reflector["resourceVersion"] or "", safe="")
+    conn = open_connection(module)
+    conn.timeout = WATCH_TIMEOUT + 30
+    try:
+        conn.request("GET", path, None, {'Authorization': 'Bearer '+module.params.get("auth_token")})
+        resp = conn.getresponse()
+        if resp.status != 200:
+            raise DaemonError("Watch of "+reflector["collection"]+" failed ("+str(resp.status)+")")
+        for line in iter_lines(resp):
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            obj = event.get("object") or {}
+            if event.get("type") == "ERROR":
+                raise DaemonError("Watch of "+reflector["collection"]+" ended: "+str(obj.get("message")))
+            with reflector["lock"]:
+                name = obj["metadata"]["name"]
+                if event.get("type") == "DELETED":
+                    reflector["items"].pop(name, None)
+                elif event.get("type") in ("ADDED", "MODIFIED"):
+                    reflector["items"][name] = obj
+                reflector["resourceVersion"] = obj["metadata"].get("resourceVersion")
+    finally:
+        conn.close()
+
+# Lines of a streamed response, as they arrive.
+def iter_lines(resp):
+    buf = ""
+    while True:
+        if resp.chunked:
+            size = int(resp.fp.readline().split(";")[0], 16)
+            if size == 0:
+                return
+            chunk = resp.fp.read(size)
+            resp.fp.read(2)
+        else:
+            chunk = resp.fp.readline()
+            if not chunk:
+                return
+        buf = buf+chunk
+        while "\n" in buf:
+            line, buf = buf.split("\n", 1)
+            yield line
+
+def reflector_written(reflector, resource_version):
+    with reflector["lock"]:
+        try:
+            reflector["written"] = max(reflector["written"], int(resource_version))
+        except (TypeError, ValueError):
+            # No comparable resourceVersion, e.g. from a DELETE. Let the
+            # watch catch up before answering from the store again.
+            reflector["dirty_until"] = time.time() + 5
+
+def reflector_get(reflector, name):
+    with reflector["lock"]:
+        if not reflector["synced"].is_set() or time.time() < reflector["dirty_until"]:
+            return dict(status="unavailable")
+        try:
+            if int(reflector["resourceVersion"]) < reflector["written"]:
+                return dict(status="unavailable")
+        except (TypeError, ValueError):
+            if reflector["written"]:
+                return dict(status="unavailable")
+        item = reflector["items"].get(name)
+        if item is None:
+            return dict(status=404)
+        return dict(status=200, object=item)
+
+#####################################
+# Broker
+# With broker enabled, requests are not sent by the module itself but by a
+# local broker daemon, reached over a Unix socket in cache_dir. The broker
+# keeps up to broker_connections keep-alive connections to the master and
+# shares them between all forks, so a run with many forks needs only a
+# handful of connections and no per task connection setup. The broker is
+# started on demand and exits after broker_idle_timeout idle seconds.
+#
+#####################################
+def broker_socket(module):
+    return daemon_socket(module, "broker")
+
+# Sends a request through the broker. Returns the response like http_send,
+# or None when the broker can not be reached and the request was not sent.
+def broker_send(method, path, module, data, headers):
+    timeout = request_timeout(module)
+    message = dict(method=method, path=path, headers=headers, timeout=timeout,
+                   data=base64.b64encode(data) if data is not None else None,
+                   coalesce=module.params.get("coalesce_gets"))
+    # A POST that reached the broker must not be sent again.
+    reply = unix_call(broker_socket(module), message, module, broker_serve,
+                      timeout=timeout+5, resend=(method != "POST"))
+    if reply is None:
+        return None
+    if reply.get("status") == "unavailable":
+        # The broker failed the request like the module would, e.g. as it
+        # could not load ca_bundle.
+        module.fail_json(msg=reply.get("msg") or "Broker failed to send the request")
+    if not isinstance(reply.get("status"), int):
+        reason = reply.get("error", "Connection to broker lost")
+        if reply.get("timeout"):
+            reason = socket.timeout(reason)
+        elif reply.get("tls_failed"):
+            reason = ssl.SSLError(reason)
+        err = urllib2.URLError(reason)
+        err.sent = reply.get("sent", True)
+        err.tls_failed = reply.get("tls_failed", False)
+        raise err
+    resp_headers = httplib.HTTPMessage(StringIO(reply["headers"]))
+    return reply["status"], reply["reason"], resp_headers, base64.b64decode(reply["body"])
+
+# Entry point of the broker daemon.
+def broker_serve(sock_path, params):
+    slots = threading.BoundedSemaphore(max(1, params.get("broker_connections")))
+    flights = dict()
+    flights_lock = threading.Lock()
+
+    def send(request):
+        module = DaemonModule(dict(params, request_timeout=request.get("timeout")))
+        data = request.get("data")
+        if data is not None:
+            data = base64.b64decode(data)
+        with slots:
+            try:
+                status, reason, resp_headers, body = pooled_send(request["method"], request["path"], module,
+                                                                 data, request["headers"])
+            except urllib2.URLError as ue:
+                return dict(error=str(ue.reason), sent=ue.sent, timeout=isinstance(ue.reason, socket.timeout),
+                            tls_failed=getattr(ue, "tls_failed", False))
+        return dict(status=status, reason=reason, headers="".join(resp_headers.headers),
+                    body=base64.b64encode(body))
+
+    def handle(request):
+        if request["method"] != "GET" or not request.get("coalesce"):
+            return send(request)
+        key = (request["path"], request["headers"].get("Authorization"),
+               request["headers"].get("Accept"), request["headers"].get("If-None-Match"))
+        return singleflight(flights, flights_lock, key, lambda: send(request))
+
+    serve_unix(sock_path, handle, params.get("broker_idle_timeout"))
+
+#####################################
+# Request coalescing
+# With coalesce_gets enabled, identical GETs (same master, path, token and
+# representation) that are in flight at the same time are sent once and share the response.
+# Inside the broker this is done in memory. Without the broker the forks
+# coordinate through a lock file per request in cache_dir: the first fork
+# sends the request, the others append a byte to the lock file and wait for
+# the lock. The response is only stored if someone waits for it, and the
+# waiting forks use it if it was received after they arrived. The last fork
+# of a flight removes its files.
+#
+#####################################
+def coalesced_send(method, path, module, data, headers):
+    filename = cache_file(module, "flight:"+path+"\0"+headers.get("Accept", "")+"\0"+headers.get("If-None-Match", ""), ".flight")
+    arrived = time.time()
+    while True:
+        with open(filename+".lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                waited = False
+            except IOError:
+                lock.write(".")
+                lock.flush()
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                waited = True
+            try:
+                if not same_file(lock, filename+".lock"):
+                    # Removed by the last fork of an earlier flight.
+                    continue
+                if waited:
+                    lock.truncate(os.fstat(lock.fileno()).st_size - 1)
+                    flight = read_cache_file(filename)
+                    if flight is not None and flight["received"] >= arrived:
+                        if os.fstat(lock.fileno()).st_size == 0:
+                            remove_files(filename, filename+".lock")
+                        resp_headers = httplib.HTTPMessage(StringIO(flight["headers"]))
+                        return flight["status"], flight["reason"], resp_headers, base64.b64decode(flight["body"])
+                try:
+                    status, reason, resp_headers, body = pooled_send(method, path, module, data, headers)
+                except Exception:
+                    # The waiting forks send the request themselves.
+                    if os.fstat(lock.fileno()).st_size == 0:
+                        remove_files(filename, filename+".lock")
+                    raise
+                if os.fstat(lock.fileno()).st_size == 0:
+                    remove_files(filename, filename+".lock")
+                else:
+                    flight = dict(received=time.time(), status=status, reason=reason,
+                                  headers="".join(resp_headers.headers), body=base64.b64encode(body))
+                    write_cache_file(filename, dict_to_json(flight))
+                return status, reason, resp_headers, body
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+# True if the open file f is still the file at path.
+def same_file(f, path):
+    try:
+        return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+    except OSError:
+        return False
+
+def remove_files(*paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+# Runs fn once for all concurrent callers with the same key and returns its
+# result to all of them.
+def singleflight(flights, lock, key, fn):
+    with lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = dict(done=threading.Event(), result=dict(error="Request failed", sent=False))
+            flights[key] = flight
+    if not leader:
+        flight["done"].wait()
+        return flight["result"]
+    try:
+        flight["result"] = fn()
+    finally:
+        with lock:
+            del flights[key]
+        flight["done"].set()
+    return flight["result"]
+
+#####################################
+# Concurrent requests
+# Python 2 has no event loop for non-blocking requests, so independent
+# requests are run on a small pool of threads instead. The threads share the
+# keep-alive connection pool, so no more than concurrency connections to the
+# master are open at a time.
+#
+#####################################
+
+# Runs fn(item, worker) for all items on up to concurrency threads and returns
+# the results in the order of items. worker stands in for module, as only the
+# main thread may call fail_json. An HTTPError raised by fn is returned as its
+# result.
+def concurrently(fn, items, module):
+    items = list(items)
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    pending = list(reversed(list(enumerate(items))))
+    lock = threading.Lock()
+    worker = DaemonModule(module.params, getattr(module, "check_mode", False))
+
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index, item = pending.pop()
+            try:
+                results[index] = fn(item, worker)
+            except urllib2.HTTPError as e:
+                results[index] = e
+            except Exception as e:
+                errors[index] = e
+
+    threads = [threading.Thread(target=work) for i in range(min(max(module.params.get("concurrency"), 1), len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    save_concurrency_limit(module)
+    for error in errors:
+        if isinstance(error, DaemonError):
+            module.fail_json(msg=str(error))
+        if error is not None:
+            raise error
+    return results
+
+#####################################
+# Adaptive concurrency
+# With adaptive_concurrency enabled, the number of requests in flight to a
+# master is limited to a value that is learned from the responses, up to
+# concurrency. The limit grows by one after every round of healthy responses
+# and is halved on 429, 5xx, connection errors or when the p95 latency of a
+# round is more than twice the usual. The learned limit is kept in cache_dir
+# as the starting point for the next task.
+#
+#####################################
+_CONCURRENCY_LIMITS = dict()
+
+class ConcurrencyLimit(object):
+    def __init__(self, limit, maximum, latency=None):
+        self.limit = min(max(float(limit), 1.0), maximum)
+        self.maximum = maximum
+        self.latency = latency
+        self.in_flight = 0
+        self.samples = []
+        self.failed = False
+        # Responses to requests sent before the last decrease do not count,
+        # so that one burst of errors halves the limit only once.
+        self.generation = 0
+        self.cond = threading.Condition()
+
+    # Waits for a free slot and returns the generation to pass to release.
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            return self.generation
+
+    def release(self, generation, latency, failed):
+        with self.cond:
+            self.in_flight -= 1
+            if generation == self.generation:
+                self.samples.append(latency)
+                self.failed = self.failed or failed
+                if self.failed or len(self.samples) >= self.limit:
+                    self.adjust()
+            self.cond.notify_all()
+
+    def adjust(self):
+        samples = sorted(self.samples)
+        p95 = samples[min(int(len(samples) * 0.95), len(samples) - 1)]
+        if self.latency is None:
+            self.latency = p95
+        if self.failed or p95 > 2 * self.latency:
+            self.limit = max(self.limit / 2, 1.0)
+            self.generation += 1
+        else:
+            self.limit = min(self.limit + 1, self.maximum)
+        # Follows lasting changes in latency, but not single slow rounds.
+        self.latency += (p95 - self.latency) / 10
+        self.samples = []
+        self.failed = False
+
+def concurrency_limit_file(module):
+    return os.path.join(get_cache_dir(module), hashlib.sha1(module.params.get("master_url")).hexdigest()+".concurrency")
+
+# The limit for the master of module, None if adaptive_concurrency is off.
+def concurrency_limit(module):
+    if not module.params.get("adaptive_concurrency"):
+        return None
+    key = module.params.get("master_url")
+    if key not in _CONCURRENCY_LIMITS:
+        maximum = max(module.params.get("concurrency"), 1)
+        state = read_cache_file(concurrency_limit_file(module)) or dict(limit=maximum // 2)
+        _CONCURRENCY_LIMITS[key] = ConcurrencyLimit(state.get("limit", 1), maximum, state.get("latency"))
+    return _CONCURRENCY_LIMITS[key]
+
+def save_concurrency_limit(module):
+    limit = concurrency_limit(module)
+    if limit is not None:
+        write_cache_file(concurrency_limit_file(module), dict_to_json(dict(limit=limit.limit, latency=limit.latency)))
+
+# http_send within the adaptive concurrency limit.
+def limited_send(method, path, module, data, headers, decode=None):
+    limit = concurrency_limit(module)
+    if limit is None:
+        return http_send(method, path, module, data, headers, decode)
+    generation = limit.acquire()
+    started = time.time()
+    failed = False
+    try:
+        response = http_send(method, path, module, data, headers, decode)
+        failed = response[0] == 429 or response[0] >= 500
+        return response
+    except urllib2.URLError:
+        failed = True
+        raise
+    finally:
+        limit.release(generation, time.time() - started, failed)
+
+#####################################
+# Local daemons
+# Helpers for the daemons the modules start on demand. A daemon serves
+# newline delimited JSON requests on a Unix socket and exits when it has been
+# idle for a while.
+#
+#####################################
+_UNIX_CONNECTIONS = dict()
+
+class DaemonError(Exception):
+    pass
+
+# A daemon connects to the master with the TLS settings of the module that
+# started it, so there is one per master, token and connection_key. Otherwise
+# a module with validate_certs could be served over a connection that was
+# never verified.
+def daemon_socket(module, name):
+    return cache_file(module, name+"\0"+repr(connection_key(module)), ".sock")
+
+# Stands in for the AnsibleModule inside a daemon or a worker thread, where a
+# failed request must raise instead of ending the process.
+class DaemonModule(object):
+    def __init__(self, params, check_mode=False):
+        self.params = params
+        self.check_mode = check_mode
+
+    def fail_json(self, **kwargs):
+        raise DaemonError(kwargs.get("msg"))
+
+# Sends one request to the daemon on sock_path and returns its reply.
+# If serve is given and no daemon is running, one is started with it.
+# Returns None when the daemon can not be reached. A request that was sent
+# but not answered is sent once more, unless resend is False, in which case
+# dict(status="lost") is returned.
+def unix_call(sock_path, message, module, serve=None, timeout=None, resend=True):
+    idle = _UNIX_CONNECTIONS.setdefault(sock_path, [])
+    for attempt in (1, 2):
+        try:
+            conn = idle.pop()
+        except IndexError:
+            conn = None
+        sent = False
+        try:
+            if conn is None:
+                sock = unix_connect(sock_path, module, serve)
+                if sock is None:
+                    return None
+                conn = (sock, sock.makefile("rb"))
+            conn[0].settimeout(timeout or request_timeout(module))
+            conn[0].sendall(dict_to_json(message)+"\n")
+            sent = True
+            line = conn[1].readline()
+            if not line:
+                raise socket.error("Connection closed by daemon")
+            reply = json.loads(line)
+            idle.append(conn)
+            return reply
+        except (socket.error, ValueError):
+            # The daemon may just have exited on idle, try once more.
+            if conn is not None:
+                conn[0].close()
+            if sent and not resend:
+                return dict(status="lost")
+    return None
+
+def unix_connect(sock_path, module, serve):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_path)
+        return sock
+    except socket.error:
+        if serve is None:
+            sock.close()
+            return None
+
+    with open(sock_path+".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                sock.connect(sock_path)
+                return sock
+            except socket.error:
+                pass
+            params = dict(module.params, informer=False, broker=False, coalesce_gets=False,
+                          task_deadline=None, retry_deadline=None)
+            spawn_daemon(serve, sock_path, params)
+            started = time.time()
+            while time.time() - started < 5:
+                try:
+                    sock.connect(sock_path)
+                    return sock
+                except socket.error:
+                    time.sleep(0.05)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    sock.close()
+    return None
+
+# Runs target(*args) in a detached process, so that Ansible does not wait
+# for it when the module exits.
+def spawn_daemon(target, *args):
+    pid = os.fork()
+    if pid > 0:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+        os.chdir("/")
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        _CONNECTIONS.clear()
+        _UNIX_CONNECTIONS.clear()
+        target(*args)
+    finally:
+        os._exit(0)
+
+def serve_unix(sock_path, handle, idle_timeout):
+    if os.path.exists(sock_path):
+        os.remove(sock_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(sock_path)
+    finally:
+        os.umask(umask)
+    server.listen(128)
+    server.settimeout(1.0)
+    state = dict(last=time.time())
+    try:
+        while time.time() - state["last"] < idle_timeout:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            state["last"] = time.time()
+            thread = threading.Thread(target=serve_unix_client, args=(conn, handle, state))
+            thread.daemon = True
+            thread.start()
+    finally:
+        # Remove the socket before closing it. A client that can no longer
+        # connect starts a new daemon, which must not lose its socket to us.
+        os.remove(sock_path)
+        server.close()
+
+def serve_unix_client(conn, handle, state):
+    conn.settimeout(None)
+    rfile = conn.makefile("rb")
+    try:
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            state["last"] = time.time()
+            try:
+                reply = handle(json.loads(line))
+            except Exception as e:
+                reply = dict(status="unavailable", msg=str(e))
+            conn.sendall(dict_to_json(reply)+"\n")
+            state["last"] = time.time()
+    except socket.error:
+        pass
+    finally:
+        conn.close()
+
+#####################################
+# Timeouts
+# request_timeout bounds every single request. task_deadline is a budget for
+# all requests made by the task, counted from when the module was started.
+# Each request and retry only gets what is left of that budget.
+#
+#####################################
+_TASK_STARTED = time.time()
+
+def task_deadline(module):
+    if module.params.get("task_deadline"):
+        return _TASK_STARTED + module.params.get("task_deadline")
+    return None
+
+# Returns the socket timeout for the next request.
+def request_timeout(module):
+    timeout = module.params.get("request_timeout")
+    deadline = task_deadline(module)
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            module.fail_json(msg="Task deadline of "+str(module.params.get("task_deadline"))+" seconds exceeded.")
+        if not timeout or remaining < timeout:
+            timeout = remaining
+    return timeout
+
+#####################################
+# Response bodies
+# Responses are requested gzip compressed and decompressed while they are
+# read. LIST responses are decoded item by item while they arrive, so the
+# whole JSON text of a large list is never held in memory.
+#
+#####################################
+STREAM_CHUNK = 65536
+JSON_DECODER = json.JSONDecoder()
+
+# Decompressed chunks of the response body.
+def iter_body(resp):
+    decompressor = None
+    if (resp.getheader("Content-Encoding") or "").lower() == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        chunk = resp.read(STREAM_CHUNK)
+        if not chunk:
+            break
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+# Reads JSON values from a stream of chunks, keeping only the unparsed part.
+class JSONStream(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return
+        self.buf = self.buf[self.pos:]+chunk
+        self.pos = 0
+
+    # Next character that is not whitespace, without consuming it.
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of JSON")
+            self.fill()
+
+    def take(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '"+char+"' in JSON")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = JSON_DECODER.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next chunk.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+# Decodes a LIST response, one item at a time.
+def decode_list(chunks):
+    stream = JSONStream(chunks)
+    page = dict()
+    stream.take("{")
+    if stream.peek() == "}":
+        return page
+    while True:
+        key = stream.value()
+        stream.take(":")
+        if key == "items" and stream.peek() == "[":
+            stream.take("[")
+            items = []
+            if stream.peek() != "]":
+                while True:
+                    items.append(stream.value())
+                    if stream.peek() != ",":
+                        break
+                    stream.take(",")
+            stream.take("]")
+            page[key] = items
+        else:
+            page[key] = stream.value()
+        if stream.peek() != ",":
+            break
+        stream.take(",")
+    stream.take("}")
+    return page
+
+#####################################
+# Server defaults
+# The master stores some values in a canonical form, e.g. the quantity 0.5
+# as 500m. That makes a desired object differ from the stored one even when
+# nothing needs to change, and e.g. a DeploymentConfig would be updated (and
+# rolled out) on every run. normalize brings the desired object into the
+# same form. The defaults the master fills in need no such handling: fields
+# missing from the desired object, also in members of keyed lists, are not
+# compared.
+#
+#####################################
+
+# Fields that hold other types. "[]" marks lists, "quantities" a map of
+# resource quantities and "intOrString" an int-or-string value.
+NORMALIZE_SCHEMAS = {
+    "DeploymentConfig":      {"spec": "DeploymentConfigSpec"},
+    "DeploymentConfigSpec":  {"template": "PodTemplateSpec", "strategy": "DeploymentStrategy"},
+    "DeploymentStrategy":    {"resources": "ResourceRequirements", "rollingParams": "RollingParams"},
+    "RollingParams":         {"maxSurge": "intOrString", "maxUnavailable": "intOrString"},
+    "BuildConfig":           {"spec": "BuildConfigSpec"},
+    "BuildConfigSpec":       {"resources": "ResourceRequirements"},
+    "PodTemplateSpec":       {"spec": "PodSpec"},
+    "PodSpec":               {"containers": "[]Container", "initContainers": "[]Container"},
+    "Container":             {"resources": "ResourceRequirements", "livenessProbe": "Probe", "readinessProbe": "Probe"},
+    "ResourceRequirements":  {"limits": "quantities", "requests": "quantities"},
+    "Probe":                 {"httpGet": "HTTPGetAction", "tcpSocket": "TCPSocketAction"},
+    "HTTPGetAction":         {"port": "intOrString"},
+    "TCPSocketAction":       {"port": "intOrString"},
+    "Service":               {"spec": "ServiceSpec"},
+    "ServiceSpec":           {"ports": "[]ServicePort"},
+    "ServicePort":           {"targetPort": "intOrString"},
+    "Route":                 {"spec": "RouteSpec"},
+    "RouteSpec":             {"port": "RoutePort"},
+    "RoutePort":             {"targetPort": "intOrString"},
+}
+
+QUANTITY = re.compile(r'^([+-]?[0-9]*\.?[0-9]+)(Ki|Mi|Gi|Ti|Pi|Ei|[numkMGTPE]?)$')
+BINARY_SUFFIXES = {"": 0, "Ki": 10, "Mi": 20, "Gi": 30, "Ti": 40, "Pi": 50, "Ei": 60}
+DECIMAL_SUFFIXES = {"n": -9, "u": -6, "m": -3, "": 0, "k": 3, "M": 6, "G": 9, "T": 12, "P": 15, "E": 18}
+
+# Copy of obj, an object of type_name, with canonical values.
+# Returns Dict.
+def normalize(obj, type_name):
+    result = dict(obj)
+    for key, field_type in NORMALIZE_SCHEMAS.get(type_name, {}).items():
+        value = result.get(key)
+        if value is None:
+            continue
+        if field_type == "intOrString":
+            result[key] = int_or_string(value)
+        elif field_type == "quantities" and isinstance(value, dict):
+            result[key] = dict((name, canonical_quantity(quantity)) for name, quantity in value.items())
+        elif field_type.startswith("[]") and isinstance(value, list):
+            result[key] = [normalize(item, field_type[2:]) if isinstance(item, dict) else item for item in value]
+        elif isinstance(value, dict):
+            result[key] = normalize(value, field_type)
+    return result
+
+# Numbers given as strings, e.g. from a Jinja2 expression, are stored as
+# port names by the master. Returns an int for those.
+def int_or_string(value):
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    return value
+
+# Formats a resource quantity like the master, e.g. 0.5 as 500m and 1024Mi
+# as 1Gi. Returns values it does not understand as they are.
+def canonical_quantity(value):
+    if isinstance(value, bool) or not isinstance(value, (basestring, int, long, float)):
+        return value
+    match = QUANTITY.match(str(value).strip())
+    if match is None:
+        return value
+    number, suffix = match.groups()
+    binary = suffix.endswith("i")
+    if binary:
+        amount = Fraction(number) * 2 ** BINARY_SUFFIXES[suffix]
+    else:
+        amount = Fraction(number) * Fraction(10) ** DECIMAL_SUFFIXES[suffix]
+
+    # Binary suffixes are kept for whole numbers from 1024 up, everything
+    # else gets a decimal suffix, rounded up to whole nanos.
+    if binary and amount.denominator == 1 and abs(amount) >= 1024:
+        mantissa, exponent = int(amount), 0
+        while mantissa % 1024 == 0 and exponent < 60:
+            mantissa, exponent = mantissa // 1024, exponent + 10
+        suffixes = dict((power, name) for name, power in BINARY_SUFFIXES.items())
+    else:
+        nanos = amount * 10 ** 9
+        mantissa, exponent = -(-nanos.numerator // nanos.denominator), -9
+        while mantissa != 0 and mantissa % 1000 == 0 and exponent < 18:
+            mantissa, exponent = mantissa // 1000, exponent + 3
+        if mantissa == 0:
+            return "0"
+        suffixes = dict((power, name) for name, power in DECIMAL_SUFFIXES.items())
+    return str(mantissa)+suffixes[exponent]
+
+#####################################
+# Protobuf
+# With wire_format protobuf, GETs of the core /api/v1 kinds handled by these
+# modules ask for the Kubernetes protobuf encoding, which is cheaper to
+# produce for the master and smaller on the wire. The response is decoded to
+# the same dict the JSON encoding gives, using the field tables below, so it
+# can be compared by compliant. Fields not in the tables are left out. Other
+# kinds, and masters that answer in JSON, are handled as JSON. Writes are
+# always sent as JSON.
+#
+#####################################
+PROTOBUF_ACCEPT = "application/vnd.kubernetes.protobuf,application/json"
+PROTOBUF_MAGIC = "k8s\x00"
+PROTOBUF_PATH = re.compile(r'^/api/v1/namespaces/[^/]+/(configmaps|serviceaccounts|services)(/[^/?]+)?(\?.*)?$')
+
+# Field number: (JSON name, type). "[]" marks repeated fields, "map" is a
+# map<string,string>, other types refer to this table.
+PROTOBUF_SCHEMAS = {
+    "Unknown":              {1: ("typeMeta", "TypeMeta"), 2: ("raw", "raw"), 3: ("contentEncoding", "string"),
+                             4: ("contentType", "string")},
+    "TypeMeta":             {1: ("apiVersion", "string"), 2: ("kind", "string")},
+    "ObjectMeta":           {1: ("name", "string"), 2: ("generateName", "string"), 3: ("namespace", "string"),
+                             4: ("selfLink", "string"), 5: ("uid", "string"), 6: ("resourceVersion", "string"),
+                             7: ("generation", "int"), 8: ("creationTimestamp", "Time"),
+                             9: ("deletionTimestamp", "Time"), 10: ("deletionGracePeriodSeconds", "int"),
+                             11: ("labels", "map"), 12: ("annotations", "map"),
+                             13: ("ownerReferences", "[]OwnerReference"), 14: ("finalizers", "[]string"),
+                             15: ("clusterName", "string")},
+    "ListMeta":             {1: ("selfLink", "string"), 2: ("resourceVersion", "string"), 3: ("continue", "string"),
+                             4: ("remainingItemCount", "int")},
+    "Time":                 {1: ("seconds", "int"), 2: ("nanos", "int")},
+    "OwnerReference":       {1: ("kind", "string"), 3: ("name", "string"), 4: ("uid", "string"),
+                             5: ("apiVersion", "string"), 6: ("controller", "bool"),
+                             7: ("blockOwnerDeletion", "bool")},
+    "Status":               {1: ("metadata", "ListMeta"), 2: ("status", "string"), 3: ("message", "string"),
+                             4: ("reason", "string"), 6: ("code", "int")},
+    "ConfigMap":            {1: ("metadata", "ObjectMeta"), 2: ("data", "map"), 3: ("binaryData", "bytesmap"),
+                             4: ("immutable", "bool")},
+    "ConfigMapList":        {1: ("metadata", "ListMeta"), 2: ("items", "[]ConfigMap")},
+    "ServiceAccount":       {1: ("metadata", "ObjectMeta"), 2: ("secrets", "[]ObjectReference"),
+                             3: ("imagePullSecrets", "[]LocalObjectReference"),
+                             4: ("automountServiceAccountToken", "bool")},
+    "ServiceAccountList":   {1: ("metadata", "ListMeta"), 2: ("items", "[]ServiceAccount")},
+    "ObjectReference":      {1: ("kind", "string"), 2: ("namespace", "string"), 3: ("name", "string"),
+                             4: ("uid", "string"), 5: ("apiVersion", "string"), 6: ("resourceVersion", "string"),
+                             7: ("fieldPath", "string")},
+    "LocalObjectReference": {1: ("name", "string")},
+    "Service":              {1: ("metadata", "ObjectMeta"), 2: ("spec", "ServiceSpec"), 3: ("status", "ServiceStatus")},
+    "ServiceList":          {1: ("metadata", "ListMeta"), 2: ("items", "[]Service")},
+    "ServiceSpec":          {1: ("ports", "[]ServicePort"), 2: ("selector", "map"), 3: ("clusterIP", "string"),
+                             4: ("type", "string"), 5: ("externalIPs", "[]string"), 7: ("sessionAffinity", "string"),
+                             8: ("loadBalancerIP", "string"), 9: ("loadBalancerSourceRanges", "[]string"),
+                             10: ("externalName", "string"), 11: ("externalTrafficPolicy", "string"),
+                             12: ("healthCheckNodePort", "int"), 13: ("publishNotReadyAddresses", "bool")},
+    "ServicePort":          {1: ("name", "string"), 2: ("protocol", "string"), 3: ("port", "int"),
+                             4: ("targetPort", "IntOrString"), 5: ("nodePort", "int"), 6: ("appProtocol", "string")},
+    "IntOrString":          {1: ("type", "int"), 2: ("intVal", "int"), 3: ("strVal", "string")},
+    "ServiceStatus":        {1: ("loadBalancer", "LoadBalancerStatus")},
+    "LoadBalancerStatus":   {1: ("ingress", "[]LoadBalancerIngress")},
+    "LoadBalancerIngress":  {1: ("ip", "string"), 2: ("hostname", "string")},
+}
+
+# Fields that the JSON encoding keeps when they are empty or zero. All other
+# fields are omitted when empty, like in the JSON encoding.
+PROTOBUF_KEEP_EMPTY = set([("ServicePort", "port"), ("ServiceAccount", "automountServiceAccountToken"),
+                           ("ConfigMap", "immutable"), ("ObjectMeta", "deletionGracePeriodSeconds"),
+                           ("OwnerReference", "controller"), ("OwnerReference", "blockOwnerDeletion")])
+
+def use_protobuf(path, module):
+    return module.params.get("wire_format") == "protobuf" and PROTOBUF_PATH.match(path) is not None
+
+def is_protobuf(resp_headers):
+    content_type = resp_headers.getheader("Content-Type") or ""
+    return content_type.startswith("application/vnd.kubernetes.protobuf")
+
+# Decodes a protobuf response into the dict the JSON encoding would give.
+# Raises ValueError if the body can not be decoded.
+def decode_protobuf(body):
+    if not body.startswith(PROTOBUF_MAGIC):
+        raise ValueError("Not a Kubernetes protobuf message")
+    try:
+        unknown = protobuf_message(body[len(PROTOBUF_MAGIC):], "Unknown")
+        type_meta = unknown.get("typeMeta", {})
+        kind = type_meta.get("kind")
+        if kind not in PROTOBUF_SCHEMAS:
+            raise ValueError("No protobuf schema for "+str(kind))
+        obj = protobuf_message(unknown.get("raw", ""), kind)
+    except (IndexError, KeyError, TypeError) as e:
+        raise ValueError("Malformed protobuf message: "+str(e))
+    obj["kind"] = kind
+    obj["apiVersion"] = type_meta.get("apiVersion")
+    return obj
+
+def protobuf_message(data, type_name):
+    schema = PROTOBUF_SCHEMAS[type_name]
+    obj = dict()
+    for number, wire_type, value in protobuf_fields(data):
+        if number not in schema:
+            continue
+        name, field_type = schema[number]
+        repeated = field_type.startswith("[]")
+        if repeated:
+            field_type = field_type[2:]
+        if field_type in ("map", "bytesmap"):
+            entry = dict((n, v) for n, w, v in protobuf_fields(value))
+            entry_value = entry.get(2, "")
+            if field_type == "map":
+                entry_value = entry_value.decode("utf-8")
+            else:
+                entry_value = base64.b64encode(entry_value)
+            obj.setdefault(name, dict())[entry.get(1, "").decode("utf-8")] = entry_value
+            continue
+        decoded = protobuf_value(value, wire_type, field_type)
+        if repeated:
+            obj.setdefault(name, []).append(decoded)
+        else:
+            obj[name] = decoded
+    for name in list(obj):
+        if obj[name] in ("", 0, None, [], {}) and (type_name, name) not in PROTOBUF_KEEP_EMPTY:
+            del obj[name]
+    return obj
+
+def protobuf_value(value, wire_type, field_type):
+    if field_type in ("int", "bool"):
+        if wire_type != 0:
+            raise ValueError("Unexpected wire type for "+field_type)
+        if field_type == "bool":
+            return bool(value)
+        # Negative numbers are sent as 64 bit two's complement.
+        if value >= 1 << 63:
+            value -= 1 << 64
+        return value
+    if wire_type != 2:
+        raise ValueError("Unexpected wire type for "+field_type)
+    if field_type == "string":
+        return value.decode("utf-8")
+    if field_type == "raw":
+        return value
+    if field_type == "Time":
+        seconds = protobuf_message(value, "Time").get("seconds", 0)
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+    if field_type == "IntOrString":
+        int_or_string = protobuf_message(value, "IntOrString")
+        if int_or_string.get("type", 0) == 1:
+            return int_or_string.get("strVal", u"")
+        return int_or_string.get("intVal", 0)
+    return protobuf_message(value, field_type)
+
+# Yields (field number, wire type, value) of a protobuf message.
+def protobuf_fields(data):
+    pos = 0
+    while pos < len(data):
+        key, pos = protobuf_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = protobuf_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = protobuf_varint(data, pos)
+            if pos + length > len(data):
+                raise ValueError("Truncated protobuf message")
+            value = data[pos:pos+length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos+8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos+4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type "+str(wire_type))
+        yield key >> 3, wire_type, value
+
+def protobuf_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+#####################################
+# Rate limit
+# With qps set, requests to a master are sent at no more than qps per second
+# on average, with bursts of up to burst requests. The token bucket is kept
+# in a file in cache_dir, so the limit holds for all forks on the controller
+# together, and for the broker and informer daemons.
+#
+#####################################
+def rate_limit(module):
+    qps = module.params.get("qps")
+    if not qps:
+        return
+    burst = max(module.params.get("burst"), 1)
+    filename = os.path.join(get_cache_dir(module), hashlib.sha1(module.params.get("master_url")).hexdigest()+".bucket")
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        now = time.time()
+        try:
+            bucket = json.loads(f.read())
+            tokens = min(burst, bucket["tokens"] + max(now - bucket["time"], 0) * qps)
+        except (ValueError, KeyError, TypeError):
+            tokens = burst
+        # Without a token, the request takes the next one ahead of time and
+        # waits until it is due. Later requests queue up behind it.
+        wait = max((1 - tokens) / qps, 0)
+        deadline = task_deadline(module)
+        if deadline is not None and now + wait > deadline:
+            module.fail_json(msg="Task deadline of "+str(module.params.get("task_deadline"))+
+                                 " seconds exceeded waiting for the rate limit of "+str(qps)+" requests per second.")
+        f.seek(0)
+        f.truncate()
+        f.write(dict_to_json(dict(tokens=tokens - 1, time=now)))
+    if wait > 0:
+        time.sleep(wait)
+
+#####################################
+# Circuit breaker
+# With circuit_failures set, a master that failed that many connections in a
+# row is taken to be down. Tasks using it then fail at once, instead of each
+# waiting for its own connection errors and retries. After circuit_cooldown
+# seconds one task is let through to probe the master. If it connects, all
+# tasks use the master again, otherwise the cool-down starts over. The state
+# is kept in cache_dir and shared by all forks.
+#
+#####################################
+def circuit_file(module):
+    return os.path.join(get_cache_dir(module), hashlib.sha1(module.params.get("master_url")).hexdigest()+".circuit")
+
+# Calls update(state) under a lock and stores the state it leaves behind.
+# Returns what update returns.
+def circuit_update(module, update):
+    fd = os.open(circuit_file(module), os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            state = json.loads(f.read())
+        except ValueError:
+            state = dict(failures=0, opened=None, probe=None)
+        result = update(state)
+        f.seek(0)
+        f.truncate()
+        f.write(dict_to_json(state))
+    return result
+
+# Fails the task if the circuit of the master is open.
+def circuit_check(module):
+    if not module.params.get("circuit_failures"):
+        return
+    state = read_cache_file(circuit_file(module))
+    if state is None or state.get("opened") is None:
+        return
+
+    def claim_probe(state):
+        now = time.time()
+        if state.get("opened") is None:
+            return None
+        wait = state["opened"] + module.params.get("circuit_cooldown") - now
+        if wait > 0:
+            return wait
+        # Only one probe at a time, unless the last one never reported back.
+        if state.get("probe") and now < state["probe"] + (module.params.get("request_timeout") or 60):
+            return 1
+        state["probe"] = now
+        return None
+
+    wait = circuit_update(module, claim_probe)
+    if wait is not None:
+        module.fail_json(msg="Open Shift Master is unreachable, "+str(state.get("failures"))+
+                             " connections failed in a row. Trying again in "+str(int(wait + 1))+" seconds.")
+
+def circuit_failed(module):
+    threshold = module.params.get("circuit_failures")
+    if not threshold:
+        return
+
+    def failed(state):
+        state["failures"] = state.get("failures", 0) + 1
+        state["probe"] = None
+        if state["failures"] >= threshold:
+            state["opened"] = time.time()
+
+    circuit_update(module, failed)
+
+def circuit_passed(module):
+    if not module.params.get("circuit_failures"):
+        return
+    state = read_cache_file(circuit_file(module))
+    if state is not None and (state.get("failures") or state.get("opened") is not None):
+        circuit_update(module, lambda state: state.update(failures=0, opened=None, probe=None))
+
+#####################################
+# Retry policy
+# Transient failures are retried with exponential backoff and full jitter,
+# bounded by the retries and retry_deadline options. Retry-After sent by the
+# master (typically with 429 and 503) is honoured.
+# GET, PUT and DELETE are retried on connection errors and on RETRY_STATUSES.
+# POST is only retried when the request never reached the master, or on 429
+# which means the master rejected it without processing it.
+#
+#####################################
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Returns number of seconds to wait before the next attempt, or None when the
+# failure should not be retried.
+def retry_delay(module, method, attempt, deadline, status=None, sent=True, retry_after=None):
+    if attempt > module.params.get("retries"):
+        return None
+
+    if status is None:
+        if method == "POST" and sent:
+            return None
+    elif status not in RETRY_STATUSES:
+        return None
+    elif method == "POST" and status != 429:
+        return None
+
+    backoff = min(module.params.get("retry_max_delay"),
+                  module.params.get("retry_delay") * (2 ** (attempt - 1)))
+    delay = random.uniform(0, backoff)
+
+    wait = parse_retry_after(retry_after)
+    if wait is not None:
+        delay = max(delay, wait)
+
+    if deadline is not None and time.time() + delay > deadline:
+        return None
+    return delay
+
+# Retry-After is either a number of seconds or a HTTP date.
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+#####################################
+# Connection pool
+# Persistent HTTP/1.1 keep-alive connections are kept per master_url for the
+# lifetime of the process, so all requests in a task share a single TCP+TLS
+# handshake. The pool is thread safe, as the broker shares it between its
+# clients.
+#
+#####################################
+_CONNECTIONS = dict()
+_CONNECTIONS_LOCK = threading.Lock()
+
+def connection_key(module):
+    url = urlparse.urlparse(module.params.get("master_url"))
+    return (url.scheme, url.netloc, module.params.get("validate_certs"), module.params.get("ca_bundle"))
+
+def get_connection(module):
+    with _CONNECTIONS_LOCK:
+        idle = _CONNECTIONS.get(connection_key(module))
+        if idle:
+            return idle.pop()
+    return open_connection(module)
+
+def release_connection(module, conn):
+    with _CONNECTIONS_LOCK:
+        _CONNECTIONS.setdefault(connection_key(module), []).append(conn)
+
+def open_connection(module):
+    url = urlparse.urlparse(module.params.get("master_url"))
+    if url.scheme == "https":
+        return httplib.HTTPSConnection(url.netloc, context=get_ssl_context(module))
+    return httplib.HTTPConnection(url.netloc)
+
+# The SSL context is built once per process and settings. Loading the trust
+# store (or ca_bundle) is the expensive part, so it is never done per request.
+_SSL_CONTEXTS = dict()
+
+def get_ssl_context(module):
+    ca_bundle = module.params.get("ca_bundle")
+    verify = bool(module.params.get("validate_certs") or ca_bundle)
+    key = (verify, ca_bundle)
+    ctx = _SSL_CONTEXTS.get(key)
+    if ctx is None:
+        try:
+            ctx = ssl.create_default_context(cafile=ca_bundle)
+        except (IOError, ssl.SSLError) as e:
+            module.fail_json(msg="Could not load ca_bundle "+str(ca_bundle)+": "+str(e))
+        if not verify:
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        _SSL_CONTEXTS[key] = ctx
+    return ctx
+
+# Sends one request over a pooled connection, or through the broker.
+# A connection that was idle in the pool may have been closed by the master
+# (or a load balancer) in the meantime. Such a failure is retried once on a
+# fresh connection, unless it was a POST that was already fully sent.
+# Returns (status, reason, headers, body). Raises URLError on connection errors.
+def http_send(method, path, module, data, headers, decode=None):
+    if module.params.get("broker"):
+        response = broker_send(method, path, module, data, headers)
+        if response is not None:
+            status, reason, resp_headers, body = response
+            if decode is not None and status == 200 and not is_protobuf(resp_headers):
+                body = decode(iter([body]))
+            return status, reason, resp_headers, body
+    if method == "GET" and module.params.get("coalesce_gets") and decode is None:
+        return coalesced_send(method, path, module, data, headers)
+    return pooled_send(method, path, module, data, headers, decode)
+
+def pooled_send(method, path, module, data, headers, decode=None):
+    path = urlparse.urlparse(module.params.get("master_url")).path.rstrip("/") + path
+    headers = dict(headers, **{"Accept-Encoding": "gzip"})
+    rate_limit(module)
+    attempt = 0
+    while True:
+        attempt += 1
+        conn = get_connection(module)
+        reused = conn.sock is not None
+        sent = False
+        conn.timeout = request_timeout(module)
+        try:
+            if conn.sock is None:
+                conn.connect()
+            else:
+                conn.sock.settimeout(conn.timeout)
+            conn.request(method, path, data, headers)
+            sent = True
+            resp = conn.getresponse()
+            chunks = iter_body(resp)
+            if decode is not None and resp.status == 200 and not is_protobuf(resp.msg):
+                body = decode(chunks)
+                # Consume what is left, e.g. a trailing newline or the gzip trailer.
+                for chunk in chunks:
+                    pass
+            else:
+                body = "".join(chunks)
+        except (socket.error, httplib.HTTPException, ssl.CertificateError, zlib.error) as e:
+            conn.close()
+            if reused and attempt == 1 and (not sent or method != "POST"):
+                continue
+            tls_failed = isinstance(e, ssl.CertificateError) or "CERTIFICATE_VERIFY_FAILED" in str(e)
+            if not tls_failed and not isinstance(e, zlib.error):
+                circuit_failed(module)
+            err = urllib2.URLError(e)
+            err.sent = sent
+            err.tls_failed = tls_failed
+            raise err
+        except ValueError:
+            # Malformed JSON from decode, the rest of the response is unread.
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            release_connection(module, conn)
+        circuit_passed(module)
+        return resp.status, resp.reason, resp.msg, body
+
 ########################### End of helper functions ############################
 
 